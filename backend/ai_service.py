@@ -1,19 +1,139 @@
+from functools import lru_cache
 from pathlib import Path
-from dedalus_labs import AsyncDedalus, DedalusRunner
+import aiofiles
+import asyncio
+from dedalus_labs import AsyncDedalus, DedalusRunner, DefaultAsyncHttpxClient
 from dotenv import load_dotenv
+from firmware_templates import TemplateMatcher
+from generate_variable_glue import strip_comments
+from llm_cache import LLMCache, SemanticCache, cache_key
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Dict
+from rate_limit import TokenBucket
+from typing import List, Optional, Dict, Tuple
+import httpx
 import json
+import os
+import random
+import re
 
-# load env vars from root if available, otherwise fallback to local
-root_env = Path(__file__).parent.parent / ".env"
-test_env = Path(__file__).parent.parent / "test_dir" / ".env"
-if root_env.exists():
-    load_dotenv(dotenv_path=root_env)
-elif test_env.exists():
-    load_dotenv(dotenv_path=test_env)
-else:
-    load_dotenv()
+
+@lru_cache(maxsize=None)
+def load_env():
+    """
+    Loads env vars from root if available, otherwise falls back to local.
+    Cached so repeat calls don't re-stat the candidate .env files.
+    """
+    root_env = Path(__file__).parent.parent / ".env"
+    test_env = Path(__file__).parent.parent / "test_dir" / ".env"
+    if root_env.exists():
+        load_dotenv(dotenv_path=root_env)
+    elif test_env.exists():
+        load_dotenv(dotenv_path=test_env)
+    else:
+        load_dotenv()
+
+
+# module-level settings below read from the environment
+load_env()
+
+# retry policy for transient provider failures (429/5xx/network)
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+# provider-facing limits: concurrent calls and requests per minute
+MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "8"))
+REQUESTS_PER_MINUTE = int(os.getenv("AI_RPM", "500"))
+
+# connection pool for the Dedalus client; idle keep-alive connections skip
+# the TLS handshake on the next call
+DEDALUS_MAX_KEEPALIVE = int(os.getenv("DEDALUS_MAX_KEEPALIVE", "16"))
+DEDALUS_MAX_CONNECTIONS = int(os.getenv("DEDALUS_MAX_CONNECTIONS", "64"))
+
+GENERATOR_MODEL = "openai/gpt-5.2"
+# Explicitly request ESP32Servo.h to avoid standard Servo.h errors on ESP32
+GENERATOR_RULES = "Use Arduino.h. If using a servo, USE <ESP32Servo.h>. NO STATICS/CONST in global scope. always detach at the start of setup and reattach."
+
+# micro-batching of generator calls: up to BATCH_SIZE specs submitted within
+# BATCH_WINDOW_MS of each other share one round-trip (0 disables batching)
+BATCH_SIZE = int(os.getenv("AI_BATCH_SIZE", "4"))
+BATCH_WINDOW_MS = float(os.getenv("AI_BATCH_WINDOW_MS", "50"))
+
+# opt-in: start a generic robustness rewrite alongside the validator instead of
+# fixing after it. The rewrite never sees the validator report, and costs one
+# discarded generator call whenever validation passes.
+SPECULATIVE_FIX = os.getenv("AI_SPECULATIVE_FIX", "0") == "1"
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def _is_retryable(error: Exception) -> bool:
+    """
+    Recoverable: rate limits, 5xx (incl. html error pages), network/timeouts.
+    Everything else (validation errors, other 4xx) fails immediately.
+    """
+    status = _status_code(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    if "<!DOCTYPE html>" in str(error):
+        return True
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return True
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+_BLANK_LINES = re.compile(r"\n(?:[ \t]*\n)+")
+_LONG_STRING = re.compile(r'"(?:\\.|[^"\\\n]){120,}"')
+
+
+def _strip_for_validation(code: str) -> str:
+    """
+    Shrinks code before it goes into the validator prompt: drops comments and
+    blank lines and elides long string literals, which cost input tokens
+    without changing what the validator checks.
+    """
+    code = strip_comments(code)
+    code = _LONG_STRING.sub(lambda m: f'"<{len(m.group()) - 2} chars>"', code)
+    return _BLANK_LINES.sub("\n", code).strip()
+
+
+def _parse_quick_verdict(text: str) -> Optional[dict]:
+    """
+    Reads a plain-text validator reply: PASS, or a {"report": [...]} object.
+    Returns None if it is neither.
+    """
+    text = text.strip()
+    lines = text.splitlines()
+    if lines and lines[0].strip().upper() == "PASS":
+        return {"report": []}
+    try:
+        data = json.loads(text[text.find("{") : text.rfind("}") + 1])
+    except Exception:
+        return None
+    report = data.get("report") if isinstance(data, dict) else None
+    if not isinstance(report, list):
+        return None
+    return {"report": [str(item) for item in report]}
+
+
+def _generator_prompt(spec: str) -> str:
+    return f"Generate firmware code for: {spec}. {GENERATOR_RULES}"
+
+
+_SETUP_LOOP = re.compile(r"\bvoid\s+(setup|loop)\s*\(\s*\)")
+
+
+def to_ai_test(code: str) -> str:
+    """
+    Transforms code to fit the multi-tasking main.cpp structure, renaming
+    setup()/loop() to ai_test_setup()/ai_test_loop() in a single pass.
+    """
+    return _SETUP_LOOP.sub(r"void ai_test_\1()", code)
 
 
 class CodeResponse(BaseModel):
@@ -29,6 +149,13 @@ class ValidationResult(BaseModel):
     )
 
 
+class CodeBatch(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    codes: List[CodeResponse] = Field(
+        description="One entry per spec, in the same order as the specs."
+    )
+
+
 class UserResponse(BaseModel):
     model_config = ConfigDict(extra="forbid")
     code: str
@@ -37,8 +164,86 @@ class UserResponse(BaseModel):
 
 class AIService:
     def __init__(self):
-        self.client = AsyncDedalus()
-        self.runner = DedalusRunner(self.client)
+        load_env()
+        self.client: Optional[AsyncDedalus] = None
+        self.runner: Optional[DedalusRunner] = None
+        self.cache = LLMCache()
+        # model/rules changes make earlier semantic matches stale
+        self.semantic_cache = SemanticCache(
+            namespace=cache_key(GENERATOR_MODEL, GENERATOR_RULES)
+        )
+        self.templates = TemplateMatcher()
+        self._batch_queue: Optional[asyncio.Queue] = None
+        self._batch_task: Optional[asyncio.Task] = None
+        self._batch_flushes: set = set()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.rate_limiter = TokenBucket(
+            rate=REQUESTS_PER_MINUTE / 60, capacity=MAX_CONCURRENCY
+        )
+
+    def ensure_runner(self) -> DedalusRunner:
+        """
+        Creates the shared client/runner on first use, with a pooled http client.
+        """
+        if self.runner is None:
+            self.client = AsyncDedalus(
+                http_client=DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_keepalive_connections=DEDALUS_MAX_KEEPALIVE,
+                        max_connections=DEDALUS_MAX_CONNECTIONS,
+                    )
+                )
+            )
+            self.runner = DedalusRunner(self.client)
+        return self.runner
+
+    async def close(self):
+        """
+        Flushes caches that batch their disk writes.
+        """
+        await self.semantic_cache.flush()
+
+    async def warm_up(self):
+        """
+        Opens a pooled connection ahead of the first real request with a cheap
+        models listing. Best-effort: failures are only logged.
+        """
+        self.ensure_runner()
+        try:
+            await self.client.models.list()
+            print("[AI] connection pool warmed up")
+        except Exception as e:
+            print(f"[AI] warm-up failed: {e}")
+
+    async def _run_with_retry(self, **kwargs):
+        """
+        Wraps runner.run with capped exponential backoff plus jitter, under
+        the concurrency cap and the token-bucket rate limit.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    await self.rate_limiter.acquire()
+                    result = await self.ensure_runner().run(**kwargs)
+                self.rate_limiter.increase()
+                return result
+            except Exception as e:
+                if _status_code(e) == 429:
+                    self.rate_limiter.decrease()
+                if attempt >= MAX_RETRIES or not _is_retryable(e):
+                    raise
+                delay = min(
+                    RETRY_BASE_DELAY * 2**attempt * (1 + random.uniform(0, 0.5)),
+                    RETRY_MAX_DELAY,
+                )
+                print(
+                    f"[Retry] {type(e).__name__} on attempt {attempt + 1}, retrying in {delay:.1f}s"
+                )
+                await asyncio.sleep(delay)
+                attempt += 1
 
     async def firmware_generator(self, spec: str) -> str:
         """
@@ -46,11 +251,17 @@ class AIService:
         Uses research tools to find relevant libraries/datasheets.
         """
         print(f"\n[Tool: Generator] Researching and generating for: {spec}...")
+        prompt = _generator_prompt(spec)
+        key = cache_key(GENERATOR_MODEL, CodeResponse.__name__, prompt)
+        cached = await self.cache.get(key)
+        if cached is not None:
+            print("[Tool: Generator] cache hit")
+            return cached
+
         try:
-            # Explicitly request ESP32Servo.h to avoid standard Servo.h errors on ESP32
-            result = await self.runner.run(
-                input=f"Generate firmware code for: {spec}. Use Arduino.h. If using a servo, USE <ESP32Servo.h>. NO STATICS/CONST in global scope. always detach at the start of setup and reattach.",
-                model="openai/gpt-5.2",
+            result = await self._run_with_retry(
+                input=prompt,
+                model=GENERATOR_MODEL,
                 response_format=CodeResponse,
             )
 
@@ -58,43 +269,283 @@ class AIService:
             raw = result.final_output
             if isinstance(raw, str):
                 try:
-                    data = json.loads(raw)
-                    return data.get("code", raw)
+                    code = json.loads(raw).get("code", raw)
                 except Exception:
-                    return raw
-            return getattr(raw, "code", str(raw))
+                    code = raw
+            else:
+                code = getattr(raw, "code", str(raw))
         except Exception as e:
             print(f"\n[Tool: Generator] ERROR: {e}")
             raise e
 
+        await self.cache.set(key, code)
+        return code
+
+    async def firmware_generator_batch(
+        self, specs: List[str], return_exceptions: bool = False
+    ) -> List[str]:
+        """
+        Generates firmware for several specs, row-marshaling up to BATCH_SIZE
+        specs into a single prompt. Specs missing from a batched response fall
+        back to individual generator calls.
+        With return_exceptions, like asyncio.gather, a spec whose fallback call
+        fails gets its exception in its slot instead of failing the whole batch.
+        """
+        if len(specs) > BATCH_SIZE:
+            chunks = await asyncio.gather(
+                *[
+                    self.firmware_generator_batch(
+                        specs[i : i + BATCH_SIZE], return_exceptions
+                    )
+                    for i in range(0, len(specs), BATCH_SIZE)
+                ]
+            )
+            return [code for chunk in chunks for code in chunk]
+
+        keys = [
+            cache_key(GENERATOR_MODEL, CodeResponse.__name__, _generator_prompt(s))
+            for s in specs
+        ]
+        codes: List[Optional[str]] = [await self.cache.get(k) for k in keys]
+        missing = [i for i, code in enumerate(codes) if code is None]
+
+        if len(missing) > 1:
+            print(f"\n[Tool: Generator] Batch generating {len(missing)} specs...")
+            numbered = "\n".join(f"{n}) {specs[i]}" for n, i in enumerate(missing, 1))
+            try:
+                result = await self._run_with_retry(
+                    input=f"Generate firmware code for each of the following specs. {GENERATOR_RULES}\nReturn {{codes: [{{code: ...}}, ...]}} with exactly one entry per spec, in the same order.\n{numbered}",
+                    model=GENERATOR_MODEL,
+                    response_format=CodeBatch,
+                )
+                raw = result.final_output
+                if isinstance(raw, str):
+                    batch = [
+                        c.get("code", "") for c in json.loads(raw).get("codes", [])
+                    ]
+                else:
+                    batch = [getattr(c, "code", "") for c in getattr(raw, "codes", [])]
+            except Exception as e:
+                print(f"\n[Tool: Generator] Batch ERROR: {e}")
+                batch = []
+
+            # entries can't be matched up if the count is off, so drop them all
+            if len(batch) == len(missing):
+                for i, code in zip(missing, batch):
+                    if code:
+                        codes[i] = code
+                        await self.cache.set(keys[i], code)
+            else:
+                print(
+                    f"[Tool: Generator] Batch returned {len(batch)}/{len(missing)} entries, falling back"
+                )
+
+        missing = [i for i, code in enumerate(codes) if code is None]
+        retried = await asyncio.gather(
+            *[self.firmware_generator(specs[i]) for i in missing],
+            return_exceptions=return_exceptions,
+        )
+        for i, code in zip(missing, retried):
+            codes[i] = code
+        return codes
+
+    async def generate_for_prompt(self, prompt: str) -> str:
+        """
+        Generator entry point for user prompts: serves near-identical earlier
+        prompts from the semantic cache, otherwise goes through the batcher.
+        """
+        cached = await self.semantic_cache.get(prompt)
+        if cached is not None:
+            print("[Tool: Generator] semantic cache hit")
+            return cached
+        code = await self._generate_batched(prompt)
+        await self.semantic_cache.set(prompt, code)
+        return code
+
+    async def _generate_batched(self, spec: str) -> str:
+        """
+        Queues a spec for the micro-batching aggregator and waits for its code.
+        """
+        if BATCH_WINDOW_MS <= 0:
+            return await self.firmware_generator(spec)
+        if self._batch_task is None or self._batch_task.done():
+            self._batch_queue = asyncio.Queue()
+            self._batch_task = asyncio.create_task(self._batch_worker())
+        future = asyncio.get_running_loop().create_future()
+        await self._batch_queue.put((spec, future))
+        return await future
+
+    async def _batch_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self._batch_queue.get()]
+            deadline = loop.time() + BATCH_WINDOW_MS / 1000
+            while len(items) < BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(
+                        await asyncio.wait_for(self._batch_queue.get(), timeout)
+                    )
+                except asyncio.TimeoutError:
+                    break
+            # flush in the background so the next window starts immediately
+            flush = asyncio.create_task(self._flush_batch(items))
+            self._batch_flushes.add(flush)
+            flush.add_done_callback(self._batch_flushes.discard)
+
+    async def _flush_batch(self, items):
+        specs = [spec for spec, _ in items]
+        try:
+            if len(specs) == 1:
+                codes = [await self.firmware_generator(specs[0])]
+            else:
+                # one spec's failure must not fail the others in its window
+                codes = await self.firmware_generator_batch(
+                    specs, return_exceptions=True
+                )
+        except Exception as e:
+            codes = [e] * len(items)
+        for (_, future), code in zip(items, codes):
+            if future.done():
+                continue
+            if isinstance(code, BaseException):
+                future.set_exception(code)
+            else:
+                future.set_result(code)
+
     async def firmware_validator(self, code: str, original_request: str) -> dict:
         """
         Validates generated code against the original request.
         """
         print(f"\n[Tool: Validator] Checking code against: {original_request}...")
+        stripped = _strip_for_validation(code)
+        context = f"Verify this code against: '{original_request}'. Check pins for esp-wroom-32. Comments are stripped and long string literals are shown as \"<N chars>\"."
+        # plain-text first pass: a passing verdict costs ~1 output token
+        # instead of a full structured JSON response
+        prompt = f'{context} Reply with exactly PASS on its own line if the code is valid; otherwise reply with a JSON object {{"report": [...]}} listing what is wrong.\nCode:\n{stripped}'
+        model = "xai/grok-4-1-fast-reasoning"
+        mcp_servers = ["kuax/dedalus_server"]
+        # key on the mcp servers too so tool changes invalidate old verdicts
+        key = cache_key(model, ValidationResult.__name__, ",".join(mcp_servers), prompt)
+        cached = await self.cache.get(key)
+        if cached is not None:
+            print("[Tool: Validator] cache hit")
+            return cached
+
         try:
-            result = await self.runner.run(
-                input=f"Verify this code against: '{original_request}'. Check pins for esp-wroom-32. Return empty report [] if PASS.\nCode:\n{code}",
-                model="xai/grok-4-1-fast-reasoning",
-                mcp_servers=["kuax/dedalus_server"],
-                response_format=ValidationResult,
+            result = await self._run_with_retry(
+                input=prompt,
+                model=model,
+                mcp_servers=mcp_servers,
             )
+            validation = _parse_quick_verdict(str(result.final_output))
 
-            raw = result.final_output
-            if isinstance(raw, str):
-                try:
-                    return json.loads(raw)
-                except Exception:
-                    return {"report": [raw]}
-            if hasattr(raw, "model_dump"):
-                return raw.model_dump()
-            return (
-                {"report": []} if "PASS" in str(raw).upper() else {"report": [str(raw)]}
-            )
+            if validation is None:
+                # unparseable verdict, fall back to the structured output path
+                result = await self._run_with_retry(
+                    input=f"{context} Return empty report [] if PASS.\nCode:\n{stripped}",
+                    model=model,
+                    mcp_servers=mcp_servers,
+                    response_format=ValidationResult,
+                )
+
+                raw = result.final_output
+                if isinstance(raw, str):
+                    try:
+                        validation = json.loads(raw)
+                    except Exception:
+                        validation = {"report": [raw]}
+                elif hasattr(raw, "model_dump"):
+                    validation = raw.model_dump()
+                else:
+                    validation = (
+                        {"report": []}
+                        if "PASS" in str(raw).upper()
+                        else {"report": [str(raw)]}
+                    )
         except Exception as e:
             print(f"\n[Tool: Validator] ERROR: {e}")
             raise e
 
+        await self.cache.set(key, validation)
+        return validation
+
+    async def fix_firmware(
+        self, original_request: str, code: str, report: List[str]
+    ) -> str:
+        """
+        Regenerates the firmware once, feeding the validator report back in.
+        Returns the original code untouched if the report is empty.
+        """
+        if not report:
+            return code
+        issues = "\n".join(f"- {item}" for item in report)
+        return await self.firmware_generator(
+            f"{original_request}\nFix these issues in the previous attempt:\n{issues}\nPrevious code:\n{code}"
+        )
+
+    async def review_firmware(
+        self, original_request: str, code: str
+    ) -> Tuple[str, List[str], bool]:
+        """
+        Validates code and returns (final code, validator report, fixed), where
+        fixed means the code was regenerated with the report's issues.
+        With SPECULATIVE_FIX, a robustness rewrite runs alongside the validator
+        and is cancelled if validation passes; it never sees the report, so
+        its result is returned with fixed=False.
+        """
+        if not SPECULATIVE_FIX:
+            validation = await self.firmware_validator(code, original_request)
+            report = validation.get("report", [])
+            fixed = await self.fix_firmware(original_request, code, report)
+            return fixed, report, bool(report)
+
+        val_task = asyncio.create_task(self.firmware_validator(code, original_request))
+        fix_task = asyncio.create_task(
+            self.firmware_generator(
+                f"{original_request}\nImprove robustness of this code:\n{code}"
+            )
+        )
+        # a cancelled/failed speculative call is never awaited; don't warn about it
+        fix_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        try:
+            report = (await val_task).get("report", [])
+        except BaseException:
+            fix_task.cancel()
+            raise
+        if not report:
+            fix_task.cancel()
+            return code, report, False
+        return await fix_task, report, False
+
+    async def process_requests(self, prompts: List[str]) -> List[Dict[str, str]]:
+        """
+        Runs generate -> validate -> (fix) for independent prompts concurrently.
+        Each stage is a gather over all prompts, so N prompts cost roughly one
+        round-trip per stage instead of N.
+        """
+        codes = await asyncio.gather(*[self.generate_for_prompt(p) for p in prompts])
+        reviewed = await asyncio.gather(
+            *[self.review_firmware(p, c) for p, c in zip(prompts, codes)]
+        )
+
+        outputs = []
+        for code, report, fixed in reviewed:
+            if report:
+                header = (
+                    "Validator flagged issues (fixed):"
+                    if fixed
+                    else "Validator flagged issues (not addressed by the returned code):"
+                )
+                feedback = header + "\n" + "\n".join(f"- {item}" for item in report)
+            else:
+                feedback = "Validation passed."
+
+            outputs.append({"code": to_ai_test(code), "user_feedback": feedback})
+        return outputs
+
     async def run_pipeline(
         self, prompt: str, history: Optional[List[Dict[str, str]]] = None
     ) -> UserResponse:
@@ -106,50 +557,18 @@ class AIService:
 
         history.append({"role": "user", "content": prompt})
 
-        instructions = """You are a firmware coordinator for esp-wroom-32.
-        SEQUENCE:
-        1. Verify pins using 'get_doc' tools.
-        2. Call firmware_generator.
-        3. Call firmware_validator.
-        4. If validator report is NOT empty, call firmware_generator ONCE more to fix.
-        5. If validator report IS empty (pass), IMMEDIATELY stop and return success result.
-        """
+        templated = self.templates.match(prompt)
+        if templated is not None:
+            name, code = templated
+            print(f"[Template] '{name}' matched, skipping generation")
+            return {
+                "code": to_ai_test(code),
+                "user_feedback": f"Used the built-in '{name}' template.",
+            }
 
         try:
-            result = await self.runner.run(
-                messages=history,
-                instructions=instructions,
-                model="openai/gpt-4o-mini",
-                mcp_servers=["kuax/dedalus_server"],
-                tools=[self.firmware_generator, self.firmware_validator],
-                response_format=UserResponse,
-            )
-
-            # result.final_output might be many things depending on runner state
-            output_raw = result.final_output
-
-            # Convert to dict for flexibility
-            if isinstance(output_raw, str):
-                try:
-                    output = json.loads(output_raw)
-                except Exception:
-                    # Fallback if it's plain text (not expected with response_format)
-                    output = {"code": "", "user_feedback": output_raw}
-            elif hasattr(output_raw, "model_dump"):
-                output = output_raw.model_dump()
-            else:
-                # Fallback for unexpected types
-                output = dict(output_raw)
-
-            # transform code to fit the multi-tasking main.cpp structure
+            (output,) = await self.process_requests([prompt])
             print(f"final: {output}")
-
-            code = output.get("code", "")
-            if code:
-                output["code"] = code.replace(
-                    "void loop()", "void ai_test_loop()"
-                ).replace("void setup()", "void ai_test_setup()")
-
             return output
         except Exception as e:
             error_msg = str(e)
@@ -159,7 +578,7 @@ class AIService:
             raise Exception(error_msg)
 
     async def save_code(self, code: str, path: str = "./firmware/src/ai.cpp"):
-        Path(path).parent.mkdir(parents=True, exist_ok=True)
-        with open(path, "w") as f:
-            f.write(code)
+        await asyncio.to_thread(Path(path).parent.mkdir, parents=True, exist_ok=True)
+        async with aiofiles.open(path, "w") as f:
+            await f.write(code)
         print(f"Code saved to {path}")
@@ -0,0 +1,162 @@
+"""
+Long-lived PlatformIO build worker. Keeps the PlatformIO Python stack imported
+between builds instead of paying `pio run` startup on every /generate.
+
+Protocol: one JSON request per line on stdin ({"cmd": "build", "project_dir": ...}),
+one JSON reply per line on stdout ({"ok": bool, "output": str}).
+"""
+
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+# the worker exits after this many builds so the server restarts it fresh
+MAX_BUILDS = int(os.getenv("BUILD_WORKER_MAX_BUILDS", "20"))
+
+# replies carry the whole build log, which can exceed asyncio's 64KB line limit
+REPLY_LIMIT = 16 * 1024 * 1024
+
+
+def build(project_dir: str) -> dict:
+    from platformio.run.cli import cli as pio_cli
+
+    # capture at fd level: scons output doesn't go through sys.stdout
+    with tempfile.TemporaryFile(mode="w+") as log:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved_out, saved_err = os.dup(1), os.dup(2)
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            pio_cli.main(["--project-dir", project_dir], standalone_mode=False)
+            ok = True
+        except SystemExit as e:
+            ok = not e.code
+        except Exception as e:
+            ok = False
+            print(f"{type(e).__name__}: {e}")
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_out, 1)
+            os.dup2(saved_err, 2)
+            os.close(saved_out)
+            os.close(saved_err)
+        log.seek(0)
+        return {"ok": ok, "output": log.read()}
+
+
+def _reply(message: dict):
+    sys.stdout.write(json.dumps(message) + "\n")
+    sys.stdout.flush()
+
+
+def main():
+    try:
+        import platformio.run.cli  # noqa: F401
+    except ImportError as e:
+        _reply({"ready": False, "error": str(e)})
+        return
+    _reply({"ready": True})
+
+    for _ in range(MAX_BUILDS):
+        line = sys.stdin.readline()
+        if not line:
+            return
+        request = json.loads(line)
+        if request.get("cmd") == "build":
+            _reply(build(request["project_dir"]))
+
+
+class BuildWorker:
+    """
+    Server-side handle for the worker process. Spawns it lazily, respawns it
+    after it retires, serializes builds and falls back to the `pio run` CLI
+    when the worker can't run (e.g. platformio isn't importable).
+    """
+
+    def __init__(self, project_dir: Path):
+        self.project_dir = project_dir
+        self.available = True
+        self._proc: Optional[asyncio.subprocess.Process] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def start(self):
+        if not self.available or (self._proc and self._proc.returncode is None):
+            return
+        self._proc = await asyncio.create_subprocess_exec(
+            sys.executable,
+            str(Path(__file__)),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            limit=REPLY_LIMIT,
+        )
+        hello = await self._proc.stdout.readline()
+        if not hello or not json.loads(hello).get("ready"):
+            print(f"build worker unavailable, using pio cli: {hello.decode().strip()}")
+            self.available = False
+            await self.stop()
+
+    async def stop(self):
+        if self._proc and self._proc.returncode is None:
+            try:
+                self._proc.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            await self._proc.wait()
+        self._proc = None
+
+    async def _build_in_worker(self) -> Optional[dict]:
+        request = {"cmd": "build", "project_dir": str(self.project_dir)}
+        # a worker that just retired (or crashed) gets one respawn
+        for _ in range(2):
+            await self.start()
+            if not self.available:
+                return None
+            try:
+                self._proc.stdin.write((json.dumps(request) + "\n").encode())
+                await self._proc.stdin.drain()
+                reply = await self._proc.stdout.readline()
+            except (BrokenPipeError, ConnectionResetError):
+                reply = b""
+            if reply:
+                return json.loads(reply)
+            await self.stop()
+        return None
+
+    async def _build_with_cli(self) -> dict:
+        proc = await asyncio.create_subprocess_exec(
+            "pio",
+            "run",
+            cwd=str(self.project_dir),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+        stdout, _ = await proc.communicate()
+        return {"ok": proc.returncode == 0, "output": stdout.decode()}
+
+    async def build(self) -> str:
+        """
+        Builds the project and returns the build log.
+        Raises CalledProcessError on failure, like subprocess.run(check=True).
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            result = await self._build_in_worker()
+            if result is None:
+                result = await self._build_with_cli()
+        if not result["ok"]:
+            raise subprocess.CalledProcessError(
+                1, ["pio", "run"], output=result["output"], stderr=result["output"]
+            )
+        return result["output"]
+
+
+if __name__ == "__main__":
+    main()
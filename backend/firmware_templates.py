@@ -0,0 +1,93 @@
+"""
+Canned firmware for prompts simple enough to skip the LLM entirely.
+Only prompts that fully fit a small blink grammar match; anything else goes
+to the pipeline.
+"""
+
+import re
+from string import Template
+from typing import Optional, Tuple
+
+# output-capable esp-wroom-32 pins (no flash pins, input-only pins or UART0)
+OUTPUT_PINS = {2, 4, 5, 12, 13, 14, 15, 16, 17, 18, 19, 21, 22, 23, 25, 26, 27, 32, 33}
+
+BLINK_TEMPLATE = Template("""#include <Arduino.h>
+
+// toggles LED_PIN every BLINK_INTERVAL_MS without blocking the main loop
+int LED_PIN = $pin;
+int BLINK_INTERVAL_MS = $interval_ms;
+int ledState = LOW;
+unsigned long lastToggle = 0;
+
+void setup() {
+  pinMode(LED_PIN, OUTPUT);
+  digitalWrite(LED_PIN, ledState);
+}
+
+void loop() {
+  if (millis() - lastToggle >= (unsigned long)BLINK_INTERVAL_MS) {
+    lastToggle = millis();
+    ledState = !ledState;
+    digitalWrite(LED_PIN, ledState);
+  }
+}
+""")
+
+
+def _blink_hz(m: re.Match) -> Optional[dict]:
+    hz = float(m["hz"])
+    if hz <= 0:
+        return None
+    # one full on/off cycle per period, so toggle twice per period
+    return {"pin": m["pin"], "interval_ms": round(500 / hz)}
+
+
+def _blink_ms(m: re.Match) -> dict:
+    return {"pin": m["pin"], "interval_ms": m["ms"]}
+
+
+# the whole prompt must fit one of these, give or take filler words, so
+# negations, durations or extra pins never reach a template
+PLEASE = r"(?:please\s+)?"
+LED = r"(?:(?:the|an?)\s+)?(?:(?:built-?in|onboard)\s+)?(?:led|light)?\s*"
+PIN = rf"{LED}(?:on\s+)?(?:pin\s*(?:#|gpio\s*)?|gpio\s*)(?P<pin>\d+)"
+HZ = r"(?:at\s+)?(?P<hz>\d+(?:\.\d+)?)\s*hz"
+MS = r"every\s*(?P<ms>\d+)\s*ms"
+END = r"\s*[.!]?\s*"
+
+
+def _grammar(rate: str):
+    return [
+        # "blink LED on pin 2 at 1Hz", "blink at 1Hz the LED on pin 2"
+        re.compile(rf"\s*{PLEASE}blink\s+{PIN}\s+{rate}{END}", re.I),
+        re.compile(rf"\s*{PLEASE}blink\s+{rate}\s+{PIN}{END}", re.I),
+        # "make the LED on pin 2 blink at 1Hz"
+        re.compile(rf"\s*{PLEASE}make\s+{PIN}\s+blink\s+{rate}{END}", re.I),
+    ]
+
+
+# (name, pattern, param builder, template)
+PATTERNS = [
+    ("blink", pattern, _blink_hz, BLINK_TEMPLATE) for pattern in _grammar(HZ)
+] + [("blink", pattern, _blink_ms, BLINK_TEMPLATE) for pattern in _grammar(MS)]
+
+
+class TemplateMatcher:
+    def __init__(self, patterns=PATTERNS):
+        self.patterns = patterns
+
+    def match(self, prompt: str) -> Optional[Tuple[str, str]]:
+        """
+        Returns (template name, rendered code) or None if no template fits.
+        """
+        for name, pattern, build_params, template in self.patterns:
+            m = pattern.fullmatch(prompt)
+            if m is None:
+                continue
+            params = build_params(m)
+            if params is None:
+                return None
+            if int(params["pin"]) not in OUTPUT_PINS or int(params["interval_ms"]) <= 0:
+                return None
+            return name, template.substitute(params)
+        return None
@@ -2,40 +2,74 @@ import re
 import sys
 import os
 
+# string literals are matched first so "//" inside them isn't taken as a comment
+_COMMENT_OR_STRING = re.compile(
+    r'("(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\')|/\*.*?\*/|//[^\n]*', re.DOTALL
+)
+_BRACE = re.compile(r"[{}]")
+_VAR_PATTERN = re.compile(
+    r"(?m)^(?!.*(?:static|const))\s*\b(int\b|uint16_t\b|uint32_t\b|String\b|char\s*\*|char\b)\s*([a-zA-Z_][a-zA-Z0-9_]*(?:\s*\[\s*\d*\s*\])?)"
+)
+
+
+def strip_comments(content):
+    """
+    Removes // and /* */ comments, leaving string and char literals intact.
+    """
+    return _COMMENT_OR_STRING.sub(lambda m: m.group(1) or "", content)
+
+
+def strip_braced(content):
+    """
+    Drops everything inside {...} (and the braces), keeping only global scope.
+    Jumps from brace to brace instead of walking every character.
+    """
+    parts = []
+    brace_level = 0
+    start = 0
+    for match in _BRACE.finditer(content):
+        if brace_level == 0:
+            parts.append(content[start : match.start()])
+        brace_level += 1 if match.group() == "{" else -1
+        start = match.end()
+    if brace_level == 0:
+        parts.append(content[start:])
+    return "".join(parts)
+
+
+def extract_variables(content):
+    """
+    Returns (type, name) pairs for the non-static, non-const globals in content.
+    """
+    content = strip_comments(content)
+
+    # Simplified global scope extraction
+    global_scope_content = strip_braced(content)
+
+    # Regex to find variables
+    return _VAR_PATTERN.findall(global_scope_content)
+
 
 def generate_glue(ai_cpp_path, output_header_path):
+    """
+    Writes the extern/update glue header for ai.cpp and returns the
+    (type, name) pairs it found.
+    """
     if not os.path.exists(ai_cpp_path):
-        return
+        return []
 
     with open(ai_cpp_path, "r") as f:
         content = f.read()
 
-    # Remove comments
-    content = re.sub(r"/\*.*?\*/", "", content, flags=re.DOTALL)
-    content = re.sub(r"//.*", "", content)
+    matches = extract_variables(content)
 
-    # Simplified global scope extraction
-    global_scope_content = ""
-    brace_level = 0
-    for char in content:
-        if char == "{":
-            brace_level += 1
-        elif char == "}":
-            brace_level -= 1
-        elif brace_level == 0:
-            global_scope_content += char
-
-    # Regex to find variables
-    pattern = r"(?m)^(?!.*(?:static|const))\s*\b(int\b|uint16_t\b|uint32_t\b|String\b|char\s*\*|char\b)\s*([a-zA-Z_][a-zA-Z0-9_]*(?:\s*\[\s*\d*\s*\])?)"
-    matches = re.findall(pattern, global_scope_content)
-
-    header_content = """#ifndef AI_VARS_GEN_H
+    header_content = ["""#ifndef AI_VARS_GEN_H
 #define AI_VARS_GEN_H
 
 #include <Arduino.h>
 
 // Externs
-"""
+"""]
     for var_type, var_name in matches:
         # Handle arrays vs pointers
         if "[" in var_name:
@@ -44,47 +78,48 @@ def generate_glue(ai_cpp_path, output_header_path):
             name_only = var_name.split("[")[0].strip()
             # We don't support dynamic modification of fixed-size char arrays easily via generic pointers
             # in this hackathon, but we'll declare them.
-            header_content += f"extern {var_type} {var_name};\n"
+            header_content.append(f"extern {var_type} {var_name};\n")
         else:
-            header_content += f"extern {var_type} {var_name};\n"
+            header_content.append(f"extern {var_type} {var_name};\n")
 
-    header_content += """
+    header_content.append("""
 inline bool updateVariableGeneric(String name, String value) {
-"""
+""")
     for var_type, var_name in matches:
-        print(f"{var_name},{var_type}")
         name_only = var_name.split("[")[0].strip()
-        header_content += f'  if (name == "{name_only}") {{\n'
+        header_content.append(f'  if (name == "{name_only}") {{\n')
 
         if "int" in var_type or "uint" in var_type:
-            header_content += f"    {name_only} = ({var_type})value.toInt();\n"
+            header_content.append(f"    {name_only} = ({var_type})value.toInt();\n")
             if "LED_PIN" in name_only:
-                header_content += "    pinMode(LED_PIN, OUTPUT);\n"
+                header_content.append("    pinMode(LED_PIN, OUTPUT);\n")
         elif "String" in var_type:
-            header_content += f"    {name_only} = value;\n"
+            header_content.append(f"    {name_only} = value;\n")
         elif "char" in var_type and "*" in var_type:
-            header_content += f"    if ({name_only}) free((void*){name_only});\n"
-            header_content += f"    {name_only} = strdup(value.c_str());\n"
+            header_content.append(f"    if ({name_only}) free((void*){name_only});\n")
+            header_content.append(f"    {name_only} = strdup(value.c_str());\n")
         elif "char" in var_type and "[" in var_name:
-            header_content += (
+            header_content.append(
                 f"    strncpy({name_only}, value.c_str(), sizeof({name_only})-1);\n"
             )
-            header_content += f"    {name_only}[sizeof({name_only})-1] = '\\0';\n"
+            header_content.append(f"    {name_only}[sizeof({name_only})-1] = '\\0';\n")
 
-        header_content += "    return true;\n  }\n"
+        header_content.append("    return true;\n  }\n")
 
-    header_content += """  return false;
+    header_content.append("""  return false;
 }
 
 #endif
-"""
+""")
 
     with open(output_header_path, "w") as f:
-        f.write(header_content)
+        f.write("".join(header_content))
     # print(f"Generated {output_header_path}")
+    return matches
 
 
 if __name__ == "__main__":
     ai_cpp = "firmware/src/ai.cpp"
     output_h = "firmware/include/ai_vars_gen.h"
-    generate_glue(ai_cpp, output_h)
+    for var_type, var_name in generate_glue(ai_cpp, output_h):
+        print(f"{var_name},{var_type}")
@@ -0,0 +1,259 @@
+"""
+Caches for LLM outputs: an exact-match in-memory LRU in front of on-disk JSON,
+plus an optional embedding-similarity cache for reworded prompts.
+Set AI_CACHE_DISABLE=1 to bypass both for fresh runs.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, List, Optional
+
+# outside backend/, which the OTA static server exposes on the network
+CACHE_DIR = Path.home() / ".cache" / "firmware_backend"
+
+
+def cache_key(*parts: str) -> str:
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+
+class LLMCache:
+    def __init__(
+        self,
+        maxsize: int = 512,
+        ttl: Optional[float] = None,
+        directory: Optional[Path] = CACHE_DIR,
+    ):
+        self.maxsize = maxsize
+        # read at construction time so values from .env are picked up
+        self.ttl = ttl if ttl is not None else float(os.getenv("AI_CACHE_TTL", "3600"))
+        self.directory = directory
+        self.enabled = os.getenv("AI_CACHE_DISABLE") != "1"
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def _read_disk(self, key: str) -> Optional[tuple]:
+        path = self._path(key)
+        if not path.exists():
+            return None
+        try:
+            entry = json.loads(path.read_text())
+            return entry["created"], entry["value"]
+        except Exception:
+            return None
+
+    def _write_disk(self, key: str, created: float, value: Any):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._path(key).write_text(json.dumps({"created": created, "value": value}))
+
+    def _remember(self, key: str, created: float, value: Any):
+        self._entries[key] = (created, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+
+        entry = self._entries.get(key)
+        if entry is None and self.directory is not None:
+            entry = await asyncio.to_thread(self._read_disk, key)
+        if entry is None:
+            return None
+
+        created, value = entry
+        if time.time() - created > self.ttl:
+            self._entries.pop(key, None)
+            return None
+        self._remember(key, created, value)
+        return value
+
+    async def set(self, key: str, value: Any):
+        if not self.enabled:
+            return
+        created = time.time()
+        self._remember(key, created, value)
+        if self.directory is not None:
+            try:
+                await asyncio.to_thread(self._write_disk, key, created, value)
+            except Exception as e:
+                print(f"[Cache] failed to persist entry: {e}")
+
+
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+class SemanticCache:
+    """
+    Nearest-neighbour cache over prompt embeddings, for reworded repeats like
+    "blink LED" vs "make LED blink". Needs sentence-transformers and numpy;
+    without them it stays disabled. Entries expire after ttl and only match
+    within the same namespace (e.g. a digest of the generator model and rules).
+    """
+
+    def __init__(
+        self,
+        threshold: Optional[float] = None,
+        model_name: str = "all-MiniLM-L6-v2",
+        directory: Optional[Path] = CACHE_DIR,
+        persist_every: int = 16,
+        namespace: str = "",
+        ttl: Optional[float] = None,
+    ):
+        self.threshold = (
+            threshold
+            if threshold is not None
+            else float(os.getenv("AI_SEMANTIC_THRESHOLD", "0.92"))
+        )
+        self.model_name = model_name
+        self.directory = directory
+        self.persist_every = persist_every
+        self.namespace = namespace
+        self.ttl = ttl if ttl is not None else float(os.getenv("AI_CACHE_TTL", "3600"))
+        self.enabled = os.getenv("AI_CACHE_DISABLE") != "1"
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._vectors = None
+        self._entries: List[dict] = []
+        self._loaded = False
+        self._unsaved = 0
+        # query vectors of recent misses, reused by set() for the same prompt
+        self._recent_queries: "OrderedDict[str, Any]" = OrderedDict()
+
+    def _embed(self, text: str):
+        with self._model_lock:
+            if self._model is None:
+                from sentence_transformers import SentenceTransformer
+
+                self._model = SentenceTransformer(self.model_name)
+        return self._model.encode(text, normalize_embeddings=True)
+
+    def _load(self):
+        self._loaded = True
+        if self.directory is None:
+            return
+        vectors_path = self.directory / "semantic_vectors.npy"
+        entries_path = self.directory / "semantic_entries.json"
+        if vectors_path.exists() and entries_path.exists():
+            import numpy as np
+
+            vectors = np.load(vectors_path)
+            entries = json.loads(entries_path.read_text())
+            # drop entries from another model/rules version or past their ttl
+            keep = [i for i, entry in enumerate(entries) if self._usable(entry)]
+            if keep:
+                self._vectors = vectors[keep]
+                self._entries = [entries[i] for i in keep]
+
+    def _persist(self):
+        import numpy as np
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        np.save(self.directory / "semantic_vectors.npy", self._vectors)
+        (self.directory / "semantic_entries.json").write_text(json.dumps(self._entries))
+
+    def _usable(self, entry: dict) -> bool:
+        return (
+            entry.get("namespace") == self.namespace
+            and time.time() - entry.get("created", 0) <= self.ttl
+        )
+
+    async def _ensure_loaded(self):
+        if not self._loaded:
+            try:
+                await asyncio.to_thread(self._load)
+            except Exception as e:
+                print(f"[Cache] failed to load semantic cache, starting empty: {e}")
+                self._vectors, self._entries = None, []
+
+    async def _query_vector(self, prompt: str):
+        try:
+            return await asyncio.to_thread(self._embed, prompt)
+        except ImportError:
+            print("[Cache] sentence-transformers not installed, semantic cache off")
+        except Exception as e:
+            # e.g. the model can't be downloaded; the cache is optional, so
+            # generation carries on without it
+            print(f"[Cache] embedding failed, semantic cache off: {e}")
+        self.enabled = False
+        return None
+
+    async def get(self, prompt: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        await self._ensure_loaded()
+        # nothing stored yet: skip embedding the prompt
+        if self._vectors is None:
+            return None
+        query = await self._query_vector(prompt)
+        if query is None:
+            return None
+
+        import numpy as np
+
+        # vectors are normalized, so a single matmul gives every cosine sim
+        scores = self._vectors @ query
+        usable = np.array([self._usable(entry) for entry in self._entries])
+        scores = np.where(usable, scores, -1.0)
+        best = int(scores.argmax())
+        entry = self._entries[best]
+        # "pin 2" and "pin 4" embed almost identically, so numbers must match
+        if scores[best] < self.threshold or entry["numbers"] != _NUMBER.findall(prompt):
+            self._remember_query(prompt, query)
+            return None
+        return entry["value"]
+
+    def _remember_query(self, prompt: str, vector):
+        self._recent_queries[prompt] = vector
+        while len(self._recent_queries) > 64:
+            self._recent_queries.popitem(last=False)
+
+    async def set(self, prompt: str, value: Any):
+        if not self.enabled:
+            return
+        await self._ensure_loaded()
+        # a miss in get() already embedded this prompt
+        vector = self._recent_queries.pop(prompt, None)
+        if vector is None:
+            vector = await self._query_vector(prompt)
+        if vector is None:
+            return
+
+        import numpy as np
+
+        row = vector.reshape(1, -1)
+        self._vectors = (
+            row if self._vectors is None else np.vstack([self._vectors, row])
+        )
+        self._entries.append(
+            {
+                "prompt": prompt,
+                "numbers": _NUMBER.findall(prompt),
+                "value": value,
+                "namespace": self.namespace,
+                "created": time.time(),
+            }
+        )
+
+        self._unsaved += 1
+        if self._unsaved >= self.persist_every:
+            await self.flush()
+
+    async def flush(self):
+        """Writes unsaved entries to disk; call at shutdown so none are lost."""
+        if self.directory is None or not self._unsaved or self._vectors is None:
+            return
+        self._unsaved = 0
+        try:
+            await asyncio.to_thread(self._persist)
+        except Exception as e:
+            print(f"[Cache] failed to persist semantic cache: {e}")
@@ -0,0 +1,41 @@
+"""
+Client-side rate limiting for LLM calls, so bursts from batching/gather
+wait here instead of tripping the provider's RPM limit.
+"""
+
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Async token bucket with AIMD: the refill rate halves on every 429 and
+    creeps back towards the configured rate on each success.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.max_rate = rate
+        self.min_rate = rate / 32
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def decrease(self):
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def increase(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
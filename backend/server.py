@@ -1,25 +1,39 @@
-from typing import Tuple, List
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional, Tuple, List
+import asyncio
 import shutil
+import socket
 import subprocess
-import requests
+import uuid
+import httpx
 from fastapi import FastAPI, HTTPException
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from pathlib import Path
 from ai_service import AIService
+from build_worker import BuildWorker
+from generate_variable_glue import extract_variables, generate_glue
 
 app = FastAPI()
 ai_service = AIService()
 
+# shared client so repeat OTA triggers reuse keep-alive connections
+ota_client = httpx.AsyncClient(
+    timeout=30.0, limits=httpx.Limits(max_keepalive_connections=8)
+)
+
 # configuration
 PROJECT_ROOT = Path(__file__).parent.parent
 FIRMWARE_DIR = PROJECT_ROOT / "firmware"
 BACKEND_DIR = PROJECT_ROOT / "backend"
 FIRMWARE_SRC = FIRMWARE_DIR / "src" / "ai.cpp"
+FIRMWARE_VARS_HEADER = FIRMWARE_DIR / "include" / "ai_vars_gen.h"
 BUILD_DIR = FIRMWARE_DIR / ".pio" / "build" / "esp32dev"
 FIRMWARE_BIN = BUILD_DIR / "firmware.bin"
 STATIC_DIR = Path(__file__).parent / "static"
 STATIC_FIRMWARE_BIN = STATIC_DIR / "firmware.bin"
+STATIC_SERVER_PORT = 8000
 
 # ensure static dir exists
 STATIC_DIR.mkdir(exist_ok=True)
@@ -27,6 +41,86 @@ STATIC_DIR.mkdir(exist_ok=True)
 # mount static files
 app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 
+# persistent PlatformIO process, falls back to `pio run` if unavailable
+build_worker = BuildWorker(FIRMWARE_DIR)
+
+
+@lru_cache(maxsize=1)
+def get_local_ip() -> str:
+    """
+    Finds the LAN ip the ESP32 should download from. Computed once per process.
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect(("10.255.255.255", 1))
+        return s.getsockname()[0]
+    except Exception:
+        return "127.0.0.1"
+    finally:
+        s.close()
+
+
+# plain http.server the ESP32 downloads firmware.bin from
+static_server: Optional[subprocess.Popen] = None
+
+
+def port_is_free(port: int) -> bool:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        # same option http.server sets, so TIME_WAIT sockets from the ESP32's
+        # last download don't make the port look busy after a restart
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(("0.0.0.0", port))
+            return True
+        except OSError:
+            return False
+
+
+@app.on_event("startup")
+async def start_static_server():
+    global static_server
+    # skip if something (e.g. a previous run) is already serving the port
+    if not port_is_free(STATIC_SERVER_PORT):
+        print(f"port {STATIC_SERVER_PORT} in use, not starting static server")
+        return
+    static_server = subprocess.Popen(
+        ["python", "-m", "http.server", str(STATIC_SERVER_PORT)],
+        cwd=str(BACKEND_DIR),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+@app.on_event("shutdown")
+async def stop_static_server():
+    if static_server is not None:
+        static_server.terminate()
+
+
+@app.on_event("startup")
+async def warm_up_ai_service():
+    await ai_service.warm_up()
+
+
+@app.on_event("shutdown")
+async def close_ai_service():
+    await ai_service.close()
+
+
+@app.on_event("startup")
+async def start_build_worker():
+    await build_worker.start()
+
+
+@app.on_event("shutdown")
+async def stop_build_worker():
+    await build_worker.stop()
+
+
+@app.on_event("shutdown")
+async def close_ota_client():
+    await ota_client.aclose()
+
 
 class GenerateRequest(BaseModel):
     prompt: str
@@ -34,17 +128,121 @@ class GenerateRequest(BaseModel):
 
 
 class GenerateResponse(BaseModel):
+    job_id: str
     variables: List[Tuple[str, str]]
     code: str
     feedback: str
 
 
-@app.post("/generate", response_model=GenerateResponse)
+class JobStatus(BaseModel):
+    # queued -> compiling -> flashing -> done | failed
+    state: str = "queued"
+    error: Optional[str] = None
+    ota_response: Optional[str] = None
+
+
+# compile/flash jobs, oldest finished ones dropped once MAX_JOBS is exceeded
+MAX_JOBS = 100
+jobs: "OrderedDict[str, JobStatus]" = OrderedDict()
+build_queue: Optional[asyncio.Queue] = None
+build_consumer: Optional[asyncio.Task] = None
+
+
+def prune_jobs():
+    # queued/running jobs are never dropped, or their build would be skipped
+    finished = [
+        job_id for job_id, job in jobs.items() if job.state in ("done", "failed")
+    ]
+    for job_id in finished[: max(0, len(jobs) - MAX_JOBS)]:
+        del jobs[job_id]
+
+
+async def run_build_job(job: JobStatus, code: str, esp_ip: str):
+    # 1. save code
+    job.state = "compiling"
+    try:
+        await ai_service.save_code(code, str(FIRMWARE_SRC))
+    except Exception as e:
+        raise RuntimeError(f"Failed to save code: {e}")
+
+    # 2. compile firmware
+    print("compiling")
+    try:
+        await asyncio.to_thread(
+            generate_glue, str(FIRMWARE_SRC), str(FIRMWARE_VARS_HEADER)
+        )
+        await build_worker.build()
+        print("compilation success")
+    except subprocess.CalledProcessError as e:
+        error_msg = e.stderr if e.stderr else e.stdout
+        raise RuntimeError(f"Compilation Failed: {error_msg}")
+
+    # 3. copy binary
+    if not FIRMWARE_BIN.exists():
+        print("no firmware bin")
+        raise RuntimeError("Firmware binary not found after compilation.")
+
+    # copyfile skips the permission bits copy() would also carry over
+    shutil.copyfile(FIRMWARE_BIN, STATIC_FIRMWARE_BIN)
+
+    # 4. trigger ota
+    job.state = "flashing"
+    firmware_url = f"http://{get_local_ip()}:{STATIC_SERVER_PORT}/static/firmware.bin"
+    ota_url = f"http://{esp_ip}/ota/update?url={firmware_url}"
+    print("flashing")
+    try:
+        response = await ota_client.get(ota_url)
+    except Exception as e:
+        raise RuntimeError(f"Failed to contact ESP32: {str(e)}")
+    job.ota_response = response.text
+    if response.status_code != 200:
+        raise RuntimeError(f"OTA Trigger Failed: {response.text}")
+    job.state = "done"
+
+
+async def consume_build_jobs():
+    """
+    Runs compile/flash jobs one at a time; they all share ai.cpp and the
+    build dir, so they must not overlap.
+    """
+    while True:
+        job_id, code, esp_ip = await build_queue.get()
+        job = jobs.get(job_id)
+        if job is None:
+            build_queue.task_done()
+            continue
+        try:
+            await run_build_job(job, code, esp_ip)
+        except Exception as e:
+            print(f"job {job_id} failed: {e}")
+            job.state = "failed"
+            job.error = str(e)
+        finally:
+            build_queue.task_done()
+
+
+@app.on_event("startup")
+async def start_build_consumer():
+    global build_queue, build_consumer
+    build_queue = asyncio.Queue()
+    build_consumer = asyncio.create_task(consume_build_jobs())
+
+
+@app.on_event("shutdown")
+async def stop_build_consumer():
+    if build_consumer is not None:
+        build_consumer.cancel()
+
+
+@app.post("/generate", response_model=GenerateResponse, status_code=202)
 async def generate_firmware(request: GenerateRequest):
+    """
+    Returns the code as soon as the AI pipeline finishes; compile and OTA run
+    as a queued job that can be polled via /status/{job_id}.
+    """
     print(f"Received request: {request}")
 
     try:
-        # 1. Run pipeline
         pipeline_result = await ai_service.run_pipeline(request.prompt, history=[])
         final_code = pipeline_result["code"]
         feedback = pipeline_result["user_feedback"]
@@ -52,87 +250,19 @@ async def generate_firmware(request: GenerateRequest):
         if not final_code:
             raise HTTPException(status_code=500, detail="No code generated.")
 
-        # 2. save code
-        try:
-            await ai_service.save_code(final_code, str(FIRMWARE_SRC))
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to save code: {e}")
+        variables = [
+            (var_name, var_type) for var_type, var_name in extract_variables(final_code)
+        ]
+        print(variables)
 
-        # 3. compile firmware
-        print("compiling")
-        variables = []
-        try:
-            varsRaw = subprocess.run(
-                ["python", "./backend/generate_variable_glue.py"],
-                cwd=str(PROJECT_ROOT),
-                capture_output=True,
-                text=True,
-                check=True,
-            )
-            if varsRaw.stdout.strip():
-                variables = [a.split(",") for a in varsRaw.stdout.split()]
-            print(variables)
-            _result = subprocess.run(
-                ["pio", "run"],
-                cwd=str(FIRMWARE_DIR),
-                capture_output=True,
-                text=True,
-                check=True,
-            )
-            print("compilation success")
-
-            # Start static server on port 8000
-            try:
-                subprocess.Popen(
-                    ["python", "-m", "http.server", "8000"],
-                    cwd=str(BACKEND_DIR),
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL,
-                )
-            except Exception:
-                pass
-        except subprocess.CalledProcessError as e:
-            error_msg = e.stderr if e.stderr else e.stdout
-            raise HTTPException(
-                status_code=500, detail=f"Compilation Failed: {error_msg}"
-            )
-
-        # 4. copy binary
-        if not FIRMWARE_BIN.exists():
-            print("no firmware bin")
-            raise HTTPException(
-                status_code=500, detail="Firmware binary not found after compilation."
-            )
-
-        shutil.copy(FIRMWARE_BIN, STATIC_FIRMWARE_BIN)
-
-        # get local ip
-        import socket
-
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            s.connect(("10.255.255.255", 1))
-            IP = s.getsockname()[0]
-        except Exception:
-            IP = "127.0.0.1"
-        finally:
-            s.close()
+        job_id = uuid.uuid4().hex
+        jobs[job_id] = JobStatus()
+        prune_jobs()
+        await build_queue.put((job_id, final_code, request.esp_ip))
 
-        firmware_url = f"http://{IP}:8000/static/firmware.bin"
-        ota_url = f"http://{request.esp_ip}/ota/update?url={firmware_url}"
-
-        print("flashing")
-        try:
-            response = requests.get(ota_url, timeout=30)
-            if response.status_code != 200:
-                print(f"OTA Trigger Failed: {response.text}")
-                # We can still return the code even if OTA fails?
-                # Let's just log and continue for now or raise if strict.
-        except Exception as e:
-            print(f"Failed to contact ESP32: {str(e)}")
-
-        # Finally return the success result
-        return GenerateResponse(variables=variables, code=final_code, feedback=feedback)
+        return GenerateResponse(
+            job_id=job_id, variables=variables, code=final_code, feedback=feedback
+        )
 
     except HTTPException as he:
         raise he
@@ -142,6 +272,14 @@ async def generate_firmware(request: GenerateRequest):
         )
 
 
+@app.get("/status/{job_id}", response_model=JobStatus)
+async def job_status(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id.")
+    return job
+
+
 if __name__ == "__main__":
     import uvicorn
 
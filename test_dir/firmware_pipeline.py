@@ -1,9 +1,15 @@
-import json
 import asyncio
-import json
+import orjson
+import os
+import re
+import sys
+import threading
+import time
 from pathlib import Path
 from dedalus_labs import AsyncDedalus, DedalusRunner
 from dotenv import load_dotenv
+from generate_variable_glue import strip_braced, strip_comments
+from response_cache import ResponseCache
 from pydantic import BaseModel, Field, ConfigDict
 from typing import List
 
@@ -11,6 +17,13 @@ from typing import List
 load_dotenv()
 
 SESSION_FILE = Path(__file__).parent / "firmware_session.json"
+FIRMWARE_FILE = Path("./firmware/src/ai.cpp")
+
+# larger sketches go into the prompt as an outline instead of in full
+FIRMWARE_INLINE_LIMIT = 2048
+
+# kept identical across calls and sent first, so providers can reuse the cached prefix
+GENERATOR_SYSTEM_PROMPT = "Generate firmware code for the following specification. Do not forget to include standard libaries like Arduino.h. DONT USE STATICS OR CONST IN GLOBAL SCOPE OR #DEFINE. Ensure it includes concise comments and error handling."
 
 
 class CodeResponse(BaseModel):
@@ -26,53 +39,212 @@ class ValidationResult(BaseModel):
     )
 
 
-class UserResponse(BaseModel):
-    model_config = ConfigDict(extra="forbid")
-    code: str
-    user_feedback: str
+# a fenced block, optionally tagged json/cpp/c++, for replies that ignore the schema
+_FENCE = re.compile(r"```(?:json|cpp|c\+\+)?\s*(.*?)```", re.DOTALL)
+_FIRST_BYTE = re.compile(rb"\S")
+
+
+# setup()/loop() are renamed so main.cpp can call the generated sketch
+_SETUP_LOOP = re.compile(r"\bvoid\s+(setup|loop)\s*\(\s*\)")
+
+
+def parse_code_response(raw) -> dict:
+    """
+    Parses generator output into {"code": ...}. Plain JSON is the normal case;
+    JSON or bare C++ inside a markdown fence is accepted as a fallback.
+    """
+    if isinstance(raw, str):
+        raw = raw.encode()
+    # schema replies start with "{"; branch on that byte instead of probing
+    first = _FIRST_BYTE.search(raw)
+    if first is not None and first.group() == b"{":
+        return orjson.loads(raw)
+    match = _FENCE.search(raw.decode())
+    if match is None:
+        raise ValueError("generator reply is neither JSON nor a fenced code block")
+    body = match.group(1)
+    if body.startswith("{"):
+        return orjson.loads(body)
+    return {"code": body}
+
+
+def parse_report(raw) -> list:
+    """Reads the validator's report list from its ValidationResult JSON."""
+    return orjson.loads(raw)["report"]
+
+
+class FirmwareCache:
+    """
+    In-memory copy of the generated firmware file. It is re-read only when
+    the file's mtime changes (e.g. edited by hand), and writes go through
+    here so they never cause a re-read.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._mtime = 0.0
+        self._text = ""
+
+    def get(self) -> str:
+        try:
+            mtime = self.path.stat().st_mtime
+        except FileNotFoundError:
+            return ""
+        if mtime != self._mtime:
+            self._text = self.path.read_text()
+            self._mtime = mtime
+        return self._text
+
+    def write(self, text: str):
+        # write a sibling file and rename it over the old one, so an
+        # interrupted write never leaves a half-written sketch behind
+        tmp = self.path.with_suffix(".cpp.tmp")
+        tmp.write_bytes(text.encode())
+        os.replace(tmp, self.path)
+        self._text = text
+        self._mtime = self.path.stat().st_mtime
+
+
+def firmware_outline(code: str) -> str:
+    """Includes, globals and function signatures of a sketch, bodies dropped."""
+    return "\n".join(
+        line.rstrip()
+        for line in strip_braced(strip_comments(code)).splitlines()
+        if line.strip()
+    )
+
+
+try:
+    from prompt_toolkit import PromptSession
+except ImportError:
+    PromptSession = None
+
+
+async def read_input(prompt_session, message: str) -> str:
+    """Reads a line without blocking the event loop."""
+    if prompt_session is not None:
+        return await prompt_session.prompt_async(message)
+
+    # a daemon thread rather than asyncio.to_thread: an executor thread stuck
+    # in input() would keep the process alive after Ctrl+C until Enter is hit
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(result, error):
+        if not future.done():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def read():
+        try:
+            result, error = input(message), None
+        except Exception as e:
+            result, error = None, e
+        try:
+            loop.call_soon_threadsafe(settle, result, error)
+        except RuntimeError:
+            pass  # loop already closed
+
+    threading.Thread(target=read, daemon=True).start()
+    return await future
 
 
 def load_history() -> list[dict]:
     if SESSION_FILE.exists():
         try:
-            return json.loads(SESSION_FILE.read_text())
+            data = SESSION_FILE.read_bytes()
+            if data.lstrip().startswith(b"["):
+                # older sessions were one JSON array; rewrite them as JSONL
+                messages = orjson.loads(data)
+                SESSION_FILE.write_bytes(
+                    b"".join(orjson.dumps(m) + b"\n" for m in messages)
+                )
+                return messages
+            return [orjson.loads(line) for line in data.splitlines() if line]
         except Exception:
             return []
     return []
 
 
-def save_history(messages: list[dict]):
-    SESSION_FILE.write_text(json.dumps(messages, indent=2))
+def _append(session, messages: list[dict]):
+    session.write(b"".join(orjson.dumps(m) + b"\n" for m in messages))
+    session.flush()
+
+
+async def save_history(session, messages: list[dict]):
+    """Appends new messages to the session log (one JSON object per line)."""
+    await asyncio.to_thread(_append, session, messages)
+
+
+def clear_history(session):
+    session.seek(0)
+    session.truncate()
 
 
 async def main():
     # Initialize the Dedalus client and runner
     client = AsyncDedalus()
     runner = DedalusRunner(client)
+    cache = ResponseCache(runner)
 
     # Session management
-    history = load_history()
+    history = await asyncio.to_thread(load_history)
+    session = open(SESSION_FILE, "ab", buffering=65536)
+    prompt_session = PromptSession() if PromptSession else None
+    saved = len(history)
+    firmware = FirmwareCache(FIRMWARE_FILE)
     print("--- Firmware Generation & Validation Pipeline ---")
     print("Type your firmware request (e.g., 'Blink LED on ESP 32'). 'exit' to quit.\n")
 
-    # Define tools within main to access 'runner'
-    async def firmware_generator(spec: str) -> str:
+    # Pipeline steps, defined within main to access the cached runner
+    async def firmware_generator(spec: str) -> dict:
         """
-        Generates firmware code based on the specification.
-        Uses research tools to find relevant libraries/datasheets.
+        Generates firmware code based on the specification,
+        echoing tokens to stdout as they stream in.
         """
-        print(f"\n[Tool: Generator] Researching and generating for: {spec}...")
+        print(f"\n[Tool: Generator] Generating for: {spec}...")
+        # the current sketch gives follow-up requests ("now make it faster") context
+        current_firmware = await asyncio.to_thread(firmware.get)
+        request = f"Spec: {spec}"
+        if len(current_firmware) > FIRMWARE_INLINE_LIMIT:
+            outline = firmware_outline(current_firmware)
+            request += f"\n\nCurrent firmware (outline, bodies omitted):\n{outline}"
+        elif current_firmware:
+            request += f"\n\nCurrent firmware:\n{current_firmware}"
         try:
-            result = await runner.run(
-                input=f"Generate firmware code for the following specification. Do not forget to include standard libaries like Arduino.h. DONT USE STATICS OR CONST IN GLOBAL SCOPE OR #DEFINE. Ensure it includes concise comments and error handling.\nSpec: {spec}",
+            response_stream = cache.cached_run(
+                messages=[
+                    {"role": "system", "content": GENERATOR_SYSTEM_PROMPT},
+                    {"role": "user", "content": request},
+                ],
                 model="openai/gpt-5.2",
                 # mcp_servers=["tsion/exa", "windsor/brave-search-mcp"],
                 # mcp_servers=["kuax/dedalus_server"],
                 response_format=CodeResponse,
+                stream=True,
+                spec=spec,
+                parse=parse_code_response,
             )
-            print(f"[Tool: Generator] Code generated: {json.loads(result.final_output)}...")
-            print(json.loads(result.final_output)['code'])
-            return result.final_output
+
+            buf = bytearray()
+            # flush on newline or every ~16ms rather than once per token
+            last_flush = time.monotonic()
+            async for chunk in response_stream:
+                if hasattr(chunk, "choices") and chunk.choices:
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        content = delta.content
+                        buf.extend(content.encode())
+                        sys.stdout.write(content)
+                        now = time.monotonic()
+                        if "\n" in content or now - last_flush > 0.016:
+                            sys.stdout.flush()
+                            last_flush = now
+            sys.stdout.flush()
+            print()
+            return parse_code_response(buf)
         except Exception as e:
             print(f"\n[Tool: Generator] ERROR: {e}")
             raise e
@@ -82,13 +254,13 @@ async def main():
         Validates generated code against the original request.
         """
         print(f"\n[Tool: Validator] Checking code against: {original_request}...")
-        # print(code)
         try:
-            result = await runner.run(
+            result = await cache.cached_run(
                 input=f"Validate this firmware code against the request: '{original_request}'.\nCheck logic and security. Check syntax with the check_syntax tooling and verify pin outs work with the esp32-wroom-32 documentation with get_doc tooling. Return 'PASS' or a report.\nCode:\n{code}",
                 model="xai/grok-4-1-fast-reasoning",
                 mcp_servers=["kuax/dedalus_server"],
                 response_format=ValidationResult,
+                parse=parse_report,
             )
             print(f"[Tool: Validator] Validation complete: {result.final_output}...")
             return result.final_output
@@ -96,63 +268,63 @@ async def main():
             print(f"\n[Tool: Validator] ERROR: {e}")
             raise e
 
-    while True:
-        try:
-            user_input = input("You: ").strip()
-            if not user_input:
-                continue
-            if user_input.lower() in ["exit", "quit"]:
-                break
-            if user_input.lower() == "clear":
-                history = []
-                save_history(history)
-                print("Session cleared.\n")
-                continue
-
-            # Append user message
-            history.append({"role": "user", "content": user_input})
-
-            print("\nAssistant: ", end="", flush=True)
-
-            # Execution with orchestration using 'instructions'
-            response_stream = runner.run(
-                messages=history,
-                instructions="""You are a firmware coordinator for esp-wroom-32. For any firmware request, first use firmware_generator to create the code, then use firmware_validator to verify it, if there are any errors then RERUN the pipeline!. Pass the original user request to both tools as needed. Finally, present the code and the validation result to the user. Be descriptive in your feedback to user. 
-                
-                IMPORTANT: before starting coding, verfiy that the pin setup is valid via the documentation that you can get with get_doc in mcp server. If it doesn't then inform the user that you're changing the pin location to one that works and get to coding.""",
-                model="openai/gpt-4o-mini",
-                mcp_servers=["kuax/dedalus_server"],
-                tools=[firmware_generator, firmware_validator],
-                stream=True,
-                response_format=UserResponse,
-            )
+    try:
+        while True:
+            try:
+                # awaited, so background work keeps running while the user types
+                user_input = (await read_input(prompt_session, "You: ")).strip()
+                if not user_input:
+                    continue
+                if user_input.lower() in ["exit", "quit"]:
+                    break
+                if user_input.lower() == "clear":
+                    history = []
+                    await asyncio.to_thread(clear_history, session)
+                    saved = 0
+                    print("Session cleared.\n")
+                    continue
 
-            full_response = ""
-            async for chunk in response_stream:
-                if hasattr(chunk, "choices") and chunk.choices:
-                    delta = chunk.choices[0].delta
-                    if delta.content:
-                        content = delta.content
-                        full_response += content
-                        print(content, end="", flush=True)
-            json_response = json.loads(full_response)
-            if json_response["code"]:
-                code = (
-                    json_response["code"]
-                    .replace("void loop()", "void ai_test_loop()")
-                    .replace("void setup()", "void ai_test_setup()")
+                # Append user message
+                history.append({"role": "user", "content": user_input})
+
+                # generator then validator is a fixed plan, so run it directly
+                # instead of asking a coordinator model to make the tool calls
+                generated = await firmware_generator(user_input)
+                code = _SETUP_LOOP.sub(r"void ai_test_\1()", generated["code"])
+                # the file write overlaps the validator call
+                validation, _ = await asyncio.gather(
+                    firmware_validator(generated["code"], user_input),
+                    asyncio.to_thread(firmware.write, code),
                 )
-                open("./firmware/src/ai.cpp", "w").write(code)
+                report = parse_report(validation)
+                if report:
+                    feedback = "Validator flagged issues:\n" + "\n".join(
+                        f"- {item}" for item in report
+                    )
+                else:
+                    feedback = "Validation passed."
+                full_response = orjson.dumps(
+                    {"code": generated["code"], "user_feedback": feedback}
+                ).decode()
+                print(f"\nAssistant: {feedback}", end="")
 
-            print("\n")
-            history.append({"role": "assistant", "content": full_response})
-            save_history(history)
+                print("\n")
+                history.append({"role": "assistant", "content": full_response})
+                await save_history(session, history[saved:])
+                saved = len(history)
 
-        except KeyboardInterrupt:
-            break
-        except Exception as e:
-            print(f"\nError: {e}\n")
+            except (KeyboardInterrupt, EOFError):
+                break
+            except Exception as e:
+                print(f"\nError: {e}\n")
+    finally:
+        session.close()
+        await cache.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        # Ctrl+C while a request is in flight cancels main()
+        pass
@@ -1,7 +1,58 @@
+import itertools
 import re
 import sys
 import os
 
+import numpy as np
+
+_COMMENT_BLOCK = re.compile(r"/\*.*?\*/", re.DOTALL)
+_COMMENT_LINE = re.compile(r"//.*")
+
+# Pattern explanation:
+# (?!.*(static|const)) -> Negative lookahead to ensure line doesn't contain static or const
+# \b(int\b|uint16_t\b|uint32_t\b|String\b|char\s*\*|char\b) -> Match type
+# \s*([a-zA-Z_][a-zA-Z0-9_]*(?:\s*\[\s*\d*\s*\])?) -> Match name
+_TYPE_AND_NAME = r"\s*\b(int\b|uint16_t\b|uint32_t\b|String\b|char\s*\*|char\b)\s*([a-zA-Z_][a-zA-Z0-9_]*(?:\s*\[\s*\d*\s*\])?)"
+
+try:
+    # linear-time engine; it has no lookahead, so static/const lines are
+    # filtered after matching instead
+    import re2
+
+    _DECL = re2.compile(r"(?m)^" + _TYPE_AND_NAME)
+except ImportError:
+    re2 = None
+    _DECL = re.compile(r"(?m)^(?!.*(?:static|const))" + _TYPE_AND_NAME)
+_QUALIFIER = re.compile(r"static|const")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def strip_braced(content):
+    """
+    Returns content with every {...} block (and the braces) removed.
+    Brace depth comes from a cumulative sum over the bytes, so the scan
+    runs in numpy instead of a per-character Python loop.
+    """
+    buf = np.frombuffer(content.encode(), dtype=np.uint8)
+    opens = buf == ord("{")
+    closes = buf == ord("}")
+    steps = opens.astype(np.int32) - closes.astype(np.int32)
+    # depth before each byte, so the braces themselves are never at depth 0
+    depth_before = np.cumsum(steps) - steps
+    mask = (depth_before == 0) & ~opens & ~closes
+    return buf[mask].tobytes().decode()
+
+
+def find_declarations(text):
+    """Yields declaration matches, skipping lines that mention static/const."""
+    for match in _DECL.finditer(text):
+        if re2 is not None:
+            line_end = text.find("\n", match.start())
+            line = text[match.start() : line_end if line_end != -1 else len(text)]
+            if _QUALIFIER.search(line):
+                continue
+        yield match
+
 
 def extract_global_variables(file_path):
     if not os.path.exists(file_path):
@@ -12,9 +63,9 @@ def extract_global_variables(file_path):
         content = f.read()
 
     # Remove multi-line comments
-    content = re.sub(r"/\*.*?\*/", "", content, flags=re.DOTALL)
+    content = _COMMENT_BLOCK.sub("", content)
     # Remove single-line comments
-    content = re.sub(r"//.*", "", content)
+    content = _COMMENT_LINE.sub("", content)
 
     # Simplified approach to find global variables:
     # 1. Split by functions/scopes to identify global scope.
@@ -25,38 +76,24 @@ def extract_global_variables(file_path):
     # But specifically avoid those inside braces.
 
     # Let's remove everything inside curly braces to keep only global scope
-    # This is a naive stack-based approach for nested braces
-    global_scope_content = ""
-    brace_level = 0
-    for char in content:
-        if char == "{":
-            brace_level += 1
-        elif char == "}":
-            brace_level -= 1
-        elif brace_level == 0:
-            global_scope_content += char
+    global_scope_content = strip_braced(content)
 
     # Now look for variables in global_scope_content
     # Types: int, char*, String
     # Avoid: static, const
 
-    # Pattern explanation:
-    # (?!.*(static|const)) -> Negative lookahead to ensure line doesn't contain static or const
-    # \b(int\b|uint16_t\b|uint32_t\b|String\b|char\s*\*|char\b) -> Match type
-    # \s*([a-zA-Z_][a-zA-Z0-9_]*(?:\s*\[\s*\d*\s*\])?) -> Match name
-
-    pattern = r"(?m)^(?!.*(?:static|const))\s*\b(int\b|uint16_t\b|uint32_t\b|String\b|char\s*\*|char\b)\s*([a-zA-Z_][a-zA-Z0-9_]*(?:\s*\[\s*\d*\s*\])?)"
-
-    matches = re.findall(pattern, global_scope_content)
+    matches = find_declarations(global_scope_content)
+    first = next(matches, None)
 
-    if not matches:
+    if first is None:
         print("No matches found in global scope (excluding static/const).")
     else:
         print(f"{'Type':<15} | {'Variable Name':<25}")
         print("-" * 45)
-        for var_type, var_name in matches:
+        for match in itertools.chain([first], matches):
+            var_type, var_name = match.group(1), match.group(2)
             # Clean up formatting for output
-            clean_type = re.sub(r"\s+", " ", var_type).strip()
+            clean_type = _WHITESPACE.sub(" ", var_type).strip()
             print(f"{clean_type:<15} | {var_name:<25}")
 
 
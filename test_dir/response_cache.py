@@ -0,0 +1,250 @@
+"""
+Response cache in front of DedalusRunner.run for the test_dir scripts.
+Exact repeats are served from a shelve store keyed on the full request;
+reworded repeats of a caller-supplied natural-language spec can be served by
+embedding similarity when sentence-transformers and numpy are installed.
+Set FIRMWARE_CACHE_DISABLE=1 to always hit the model.
+"""
+
+import asyncio
+import hashlib
+import os
+import re
+import shelve
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Optional
+
+import orjson
+
+CACHE_DIR = Path.home() / ".cache" / "firmware_pipeline"
+SEMANTIC_THRESHOLD = 0.95
+
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+def _digest(payload) -> str:
+    return hashlib.blake2b(orjson.dumps(payload), digest_size=16).hexdigest()
+
+
+def _ttl() -> float:
+    # read per call so values from .env are picked up
+    return float(os.getenv("FIRMWARE_CACHE_TTL", "3600"))
+
+
+def _last_user_message(kwargs: dict) -> str:
+    if kwargs.get("input"):
+        return kwargs["input"]
+    for message in reversed(kwargs.get("messages") or []):
+        if message.get("role") == "user":
+            return message.get("content", "")
+    return ""
+
+
+def _context(kwargs: dict) -> dict:
+    """
+    Everything about the request except the latest user turn. Semantic
+    matches are only taken between requests with the same context.
+    """
+    messages = list(kwargs.get("messages") or [])
+    if messages and messages[-1].get("role") == "user":
+        messages = messages[:-1]
+    response_format = kwargs.get("response_format")
+    return {
+        "model": kwargs.get("model"),
+        "instructions": kwargs.get("instructions"),
+        "history": messages,
+        "tools": [tool.__name__ for tool in kwargs.get("tools") or []],
+        "mcp_servers": kwargs.get("mcp_servers"),
+        "response_format": getattr(response_format, "__name__", None),
+        "stream": bool(kwargs.get("stream")),
+    }
+
+
+def _semantic_context(kwargs: dict, spec: str) -> str:
+    """
+    Digest of the whole request with the spec text cut out. Anything else in
+    the prompt (e.g. the current firmware) must match exactly for a semantic hit.
+    """
+    prompt = _last_user_message(kwargs).replace(spec, "")
+    return _digest([_context(kwargs), prompt])
+
+
+def _chunk(content: str):
+    # same shape as a streamed completion chunk, as far as the scripts read it
+    delta = SimpleNamespace(content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+class ResponseCache:
+    def __init__(self, runner, directory: Path = CACHE_DIR):
+        self.runner = runner
+        self.enabled = os.getenv("FIRMWARE_CACHE_DISABLE") != "1"
+        self.semantic = True
+        directory.mkdir(parents=True, exist_ok=True)
+        self._db = shelve.open(str(directory / "responses"))
+        self._db_lock = threading.Lock()
+        self._model = None
+        self._indexing = set()
+
+    async def close(self):
+        # let background indexing finish before the store goes away
+        await asyncio.gather(*self._indexing, return_exceptions=True)
+        with self._db_lock:
+            self._db.close()
+
+    def _get(self, key: str):
+        with self._db_lock:
+            return self._db.get(key)
+
+    def _put(self, key: str, value):
+        with self._db_lock:
+            self._db[key] = value
+            self._db.sync()
+
+    def _embed(self, text: str):
+        if self._model is None:
+            from sentence_transformers import SentenceTransformer
+
+            self._model = SentenceTransformer("all-MiniLM-L6-v2")
+        return self._model.encode(text, normalize_embeddings=True)
+
+    def _semantic_lookup(self, context_key: str, spec: str) -> Optional[list]:
+        import numpy as np
+
+        entries = self._get(f"semantic:{context_key}")
+        if not entries:
+            return None
+        query = self._embed(spec)
+        scores = np.array([entry["vector"] for entry in entries]) @ query
+        best = int(scores.argmax())
+        entry = entries[best]
+        # "pin 2" and "pin 4" embed almost identically, so numbers must match
+        if scores[best] < SEMANTIC_THRESHOLD or entry["numbers"] != _NUMBER.findall(
+            spec
+        ):
+            return None
+        if time.time() - entry.get("created", 0) > _ttl():
+            return None
+        return entry["pieces"]
+
+    def _semantic_store(self, context_key: str, spec: str, pieces: list):
+        vector = self._embed(spec)
+        key = f"semantic:{context_key}"
+        entries = self._get(key) or []
+        entries.append(
+            {
+                "vector": vector.tolist(),
+                "numbers": _NUMBER.findall(spec),
+                "pieces": pieces,
+                "created": time.time(),
+            }
+        )
+        self._put(key, entries)
+
+    async def _lookup(self, kwargs: dict, spec: Optional[str]) -> Optional[list]:
+        if self._indexing:
+            await asyncio.gather(*self._indexing)
+        context = _context(kwargs)
+        prompt = _last_user_message(kwargs)
+        entry = await asyncio.to_thread(self._get, _digest([context, prompt]))
+        if isinstance(entry, dict) and time.time() - entry["created"] <= _ttl():
+            return entry["pieces"]
+        if not self.semantic or not spec:
+            return None
+        try:
+            return await asyncio.to_thread(
+                self._semantic_lookup, _semantic_context(kwargs, spec), spec
+            )
+        except ImportError:
+            print("[Cache] sentence-transformers not installed, semantic cache off")
+            self.semantic = False
+            return None
+        except Exception as e:
+            # a broken model or store must not fail the request itself
+            print(f"[Cache] semantic lookup failed, semantic cache off: {e}")
+            self.semantic = False
+            return None
+
+    async def _index(self, context_key: str, spec: str, pieces: list):
+        try:
+            await asyncio.to_thread(self._semantic_store, context_key, spec, pieces)
+        except ImportError:
+            self.semantic = False
+        except Exception as e:
+            print(f"[Cache] failed to index response: {e}")
+
+    async def _store(
+        self,
+        kwargs: dict,
+        spec: Optional[str],
+        pieces: list,
+        parse: Optional[Callable[[str], object]],
+    ):
+        if parse is not None:
+            # a reply the caller can't parse is not cached, so a retry of the
+            # same prompt goes back to the model instead of replaying it
+            try:
+                parse("".join(pieces))
+            except Exception:
+                return
+        context = _context(kwargs)
+        prompt = _last_user_message(kwargs)
+        entry = {"created": time.time(), "pieces": pieces}
+        await asyncio.to_thread(self._put, _digest([context, prompt]), entry)
+        if self.semantic and spec:
+            # embedding is slow; let it run while the user types the next prompt
+            task = asyncio.create_task(
+                self._index(_semantic_context(kwargs, spec), spec, pieces)
+            )
+            self._indexing.add(task)
+            task.add_done_callback(self._indexing.discard)
+
+    async def _run(self, kwargs: dict, spec: Optional[str], parse):
+        pieces = await self._lookup(kwargs, spec)
+        if pieces is not None:
+            return SimpleNamespace(final_output="".join(pieces))
+        result = await self.runner.run(**kwargs)
+        await self._store(kwargs, spec, [result.final_output], parse)
+        return result
+
+    async def _stream(self, kwargs: dict, spec: Optional[str], parse):
+        pieces = await self._lookup(kwargs, spec)
+        if pieces is not None:
+            for piece in pieces:
+                yield _chunk(piece)
+                await asyncio.sleep(0)
+            return
+
+        pieces = []
+        async for chunk in self.runner.run(**kwargs):
+            if hasattr(chunk, "choices") and chunk.choices:
+                content = chunk.choices[0].delta.content
+                if content:
+                    pieces.append(content)
+            yield chunk
+        # only complete responses are cached
+        await self._store(kwargs, spec, pieces, parse)
+
+    def cached_run(
+        self,
+        spec: Optional[str] = None,
+        parse: Optional[Callable[[str], object]] = None,
+        **kwargs,
+    ):
+        """
+        Drop-in for runner.run: returns an async iterator of chunks when
+        stream=True, otherwise an awaitable result with final_output.
+
+        spec: natural-language request text that may be matched by embedding
+        similarity. Leave it unset for prompts that carry code (e.g. the
+        validator), where a near-identical embedding can hide a real change.
+        parse: called on the full reply; replies it rejects are not cached.
+        """
+        if not self.enabled:
+            return self.runner.run(**kwargs)
+        if kwargs.get("stream"):
+            return self._stream(kwargs, spec, parse)
+        return self._run(kwargs, spec, parse)
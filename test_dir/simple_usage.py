@@ -1,8 +1,12 @@
 import asyncio
-import json
+import orjson
+import sys
+import threading
+import time
 from pathlib import Path
 from dedalus_labs import AsyncDedalus, DedalusRunner
 from dotenv import load_dotenv
+from response_cache import ResponseCache
 
 # Load environment variables (OPENAI_API_KEY, DEDALUS_API_KEY, etc.)
 load_dotenv()
@@ -10,26 +14,86 @@ load_dotenv()
 SESSION_FILE = Path(__file__).parent / "session.json"
 
 
+try:
+    from prompt_toolkit import PromptSession
+except ImportError:
+    PromptSession = None
+
+
+async def read_input(prompt_session, message: str) -> str:
+    """Reads a line without blocking the event loop."""
+    if prompt_session is not None:
+        return await prompt_session.prompt_async(message)
+
+    # a daemon thread rather than asyncio.to_thread: an executor thread stuck
+    # in input() would keep the process alive after Ctrl+C until Enter is hit
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(result, error):
+        if not future.done():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def read():
+        try:
+            result, error = input(message), None
+        except Exception as e:
+            result, error = None, e
+        try:
+            loop.call_soon_threadsafe(settle, result, error)
+        except RuntimeError:
+            pass  # loop already closed
+
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+
 def load_history() -> list[dict]:
     if SESSION_FILE.exists():
         try:
-            return json.loads(SESSION_FILE.read_text())
+            data = SESSION_FILE.read_bytes()
+            if data.lstrip().startswith(b"["):
+                # older sessions were one JSON array; rewrite them as JSONL
+                messages = orjson.loads(data)
+                SESSION_FILE.write_bytes(
+                    b"".join(orjson.dumps(m) + b"\n" for m in messages)
+                )
+                return messages
+            return [orjson.loads(line) for line in data.splitlines() if line]
         except Exception:
             return []
     return []
 
 
-def save_history(messages: list[dict]):
-    SESSION_FILE.write_text(json.dumps(messages, indent=2))
+def _append(session, messages: list[dict]):
+    session.write(b"".join(orjson.dumps(m) + b"\n" for m in messages))
+    session.flush()
+
+
+async def save_history(session, messages: list[dict]):
+    """Appends new messages to the session log (one JSON object per line)."""
+    await asyncio.to_thread(_append, session, messages)
+
+
+def clear_history(session):
+    session.seek(0)
+    session.truncate()
 
 
 async def main():
     # Initialize the Dedalus client and runner
     client = AsyncDedalus()
     runner = DedalusRunner(client)
+    cache = ResponseCache(runner)
 
     # Session management dictionary
-    sessions: dict[str, list[dict]] = {"default": load_history()}
+    sessions: dict[str, list[dict]] = {"default": await asyncio.to_thread(load_history)}
+    session = open(SESSION_FILE, "ab", buffering=65536)
+    prompt_session = PromptSession() if PromptSession else None
+    saved = len(sessions["default"])
     session_id = "default"
 
     print("--- Dedalus Intelligent Handoff & Session Demo ---")
@@ -41,56 +105,78 @@ async def main():
             f"Resuming session '{session_id}' with {len(sessions[session_id])} messages.\n"
         )
 
-    while True:
-        try:
-            # Take input from the user
-            user_input = input("You: ").strip()
-            if not user_input:
-                continue
-            if user_input.lower() in ["exit", "quit"]:
+    try:
+        while True:
+            try:
+                # Take input from the user
+                # awaited, so background work keeps running while the user types
+                user_input = (await read_input(prompt_session, "You: ")).strip()
+                if not user_input:
+                    continue
+                if user_input.lower() in ["exit", "quit"]:
+                    break
+                if user_input.lower() == "clear":
+                    sessions[session_id] = []
+                    await asyncio.to_thread(clear_history, session)
+                    saved = 0
+                    print("Session cleared.\n")
+                    continue
+
+                # Append user message to history
+                sessions[session_id].append({"role": "user", "content": user_input})
+                history = sessions[session_id]
+
+                print("\nAssistant: ", end="", flush=True)
+
+                # Use Intelligent Handoffs and Session Management
+                response_stream = cache.cached_run(
+                    messages=history,
+                    model=["gpt-5-mini", "gpt-5-codex", "gpt-5.2"],
+                    mcp_servers=[
+                        "tsion/exa",  # Semantic search engine
+                        "windsor/brave-search-mcp",  # Privacy-focused web search
+                    ],
+                    stream=True,
+                    spec=user_input,
+                )
+
+                buf = bytearray()
+                # flush on newline or every ~16ms rather than once per token
+                last_flush = time.monotonic()
+                async for chunk in response_stream:
+                    if hasattr(chunk, "choices") and chunk.choices:
+                        delta = chunk.choices[0].delta
+                        if delta.content:
+                            content = delta.content
+                            buf.extend(content.encode())
+                            sys.stdout.write(content)
+                            now = time.monotonic()
+                            if "\n" in content or now - last_flush > 0.016:
+                                sys.stdout.flush()
+                                last_flush = now
+                sys.stdout.flush()
+
+                # Save assistant response
+                full_response = buf.decode()
+                sessions[session_id].append(
+                    {"role": "assistant", "content": full_response}
+                )
+                await save_history(session, sessions[session_id][saved:])
+                saved = len(sessions[session_id])
+                print("\n")
+
+            except (KeyboardInterrupt, EOFError):
                 break
-            if user_input.lower() == "clear":
-                sessions[session_id] = []
-                save_history(sessions[session_id])
-                print("Session cleared.\n")
-                continue
-
-            # Append user message to history
-            sessions[session_id].append({"role": "user", "content": user_input})
-            history = sessions[session_id]
-
-            print("\nAssistant: ", end="", flush=True)
-
-            # Use Intelligent Handoffs and Session Management
-            response_stream = runner.run(
-                messages=history,
-                model=["gpt-5-mini", "gpt-5-codex", "gpt-5.2"],
-                mcp_servers=[
-                    "tsion/exa",  # Semantic search engine
-                    "windsor/brave-search-mcp",  # Privacy-focused web search
-                ],
-                stream=True,
-            )
-
-            full_response = ""
-            async for chunk in response_stream:
-                if hasattr(chunk, "choices") and chunk.choices:
-                    delta = chunk.choices[0].delta
-                    if delta.content:
-                        content = delta.content
-                        full_response += content
-                        print(content, end="", flush=True)
-
-            # Save assistant response
-            sessions[session_id].append({"role": "assistant", "content": full_response})
-            save_history(sessions[session_id])
-            print("\n")
-
-        except KeyboardInterrupt:
-            break
-        except Exception as e:
-            print(f"\nError: {e}\n")
+            except Exception as e:
+                print(f"\nError: {e}\n")
+    finally:
+        session.close()
+        await cache.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        # Ctrl+C while a request is in flight cancels main()
+        pass